@@ -2,8 +2,10 @@
 
 import os
 from argparse import Namespace
+from concurrent.futures import Future
 from pathlib import Path
 from threading import Thread
+from typing import Optional, cast
 import re
 
 import mastodon
@@ -12,7 +14,7 @@ from deltachat2 import (
     ChatType,
     CoreEvent,
     EventType,
-    JsonRpcError,
+    Message,
     MsgData,
     NewMsgEvent,
     SpecialContactId,
@@ -20,28 +22,64 @@ from deltachat2 import (
     events,
 )
 from rich.logging import RichHandler
+from sqlalchemy import delete
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from .cli import cli
 from .migrations import run_migrations
-from .orm import Account, DmChat, OAuth, Hashtags, initdb, session_scope
+from .orm import Account, DmChat, OAuth, Hashtags, initdb, read_session, session_scope
 from .util import (
-    TOOT_SEP,
+    ACCOUNT_BY_CHAT,
+    BRIDGE_CHAT,
+    COALESCER,
+    DMCHAT_ACCOUNT_BY_CHAT,
+    DMCHAT_BY_CHAT,
+    DMCHAT_BY_CONTACT,
+    DMCHATS_BY_ACCOUNT,
+    HASHTAGS_BY_CHAT,
+    NOT_LOGGED_IN,
+    PENDING_OAUTH,
+    TOOT_CHATS,
+    WRONG_USAGE,
     Visibility,
     account_action,
     download_file,
+    forget_chat_info,
+    forget_mastodon,
     get_account_from_msg,
+    get_chat_contacts,
+    get_chat_info,
     get_client,
     get_mastodon,
     get_mastodon_from_msg,
     get_profile,
     get_user,
+    iter_chunks,
+    leave_chats,
     listen_to_mastodon,
+    load_toot_chats,
     normalize_url,
     send_toot,
     toots2texts,
 )
+from .workers import FETCH_POOL, RpcBatch, run_in_executor
 
 MASTODON_LOGO = os.path.join(os.path.dirname(__file__), "mastodon-logo.png")
+TAG_SPLIT = re.compile(r"[ ,]+")
+
+
+def _reply(msg: Message, text: str) -> MsgData:
+    return MsgData(text=text, quoted_message_id=msg.id)
+
+
+def _send_toots(bot: Bot, accid: int, msg: Message, toots: list) -> None:
+    """Send the given toots as a reply to msg, split in several messages if needed."""
+    quote: Optional[int] = msg.id
+    for text in iter_chunks(toots2texts(toots)):
+        bot.rpc.send_msg(accid, msg.chat_id, MsgData(text=text, quoted_message_id=quote))
+        quote = None
+    if quote:
+        bot.rpc.send_msg(accid, msg.chat_id, _reply(msg, "❌ Nothing found"))
 
 
 @cli.on_init
@@ -65,6 +103,7 @@ def on_start(bot: Bot, args: Namespace) -> None:
     dbpath = Path(args.config_dir, "sqlite.db")
     run_migrations(bot, dbpath)
     initdb(f"sqlite:///{dbpath}")
+    load_toot_chats()
     Thread(target=listen_to_mastodon, args=(bot, args), daemon=True).start()
 
 
@@ -87,36 +126,32 @@ def log_event(bot: Bot, accid: int, event: CoreEvent) -> None:
 def on_added(bot: Bot, accid: int, event: CoreEvent) -> None:
     """Process member-added messages"""
     chatid = event.chat_id
+    forget_chat_info(accid, chatid)
 
-    with session_scope() as session:
-        dmchat = session.query(DmChat).filter_by(chat_id=chatid).first()
-        if dmchat:
-            return
-        home = session.query(Account).filter_by(home=chatid).first()
-        if home:
-            return
-        notif = session.query(Account).filter_by(notifications=chatid).first()
-        if notif:
+    with read_session() as session:
+        if session.execute(BRIDGE_CHAT, {"chatid": chatid}).first():
             return
 
-        contact_ids = [c for c in bot.rpc.get_chat_contacts(accid, chatid) if c != SpecialContactId.SELF]
+        contacts = get_chat_contacts(bot, accid, chatid)
+        contact_ids = [c for c in contacts if c != SpecialContactId.SELF]
         if len(contact_ids) != 1:
             return
 
-        info = bot.rpc.get_basic_chat_info(accid, chatid)
-        tags = re.split(r'[ ,]+', info.name)
-        if len(info.name.strip()) == 0 or False in [tag.startswith('#') for tag in tags]:
+        info = get_chat_info(bot, accid, chatid)
+        tags = TAG_SPLIT.split(info.name)
+        if len(info.name.strip()) == 0 or not all(tag.startswith("#") for tag in tags):
+            return
+
+        if session.execute(HASHTAGS_BY_CHAT, {"chatid": chatid}).first():
             return
 
-        hashtags = session.query(Hashtags).filter_by(chat_id=chatid).first()
-        if not hashtags:
-            contact_id = contact_ids[0]
-            session.add(Hashtags(chat_id=chatid, contactid=contact_id))
+    with session_scope() as session:
+        session.add(Hashtags(chat_id=chatid, contactid=contact_ids[0]))
 
-            try:
-                bot.rpc.set_chat_profile_image(accid, chatid, MASTODON_LOGO)
-            except Exception as err:
-                bot.logger.exception(err)
+    try:
+        bot.rpc.set_chat_profile_image(accid, chatid, MASTODON_LOGO)
+    except Exception as err:
+        bot.logger.exception(err)
 
 
 @cli.on(events.NewMessage(is_info=True))
@@ -131,47 +166,40 @@ def on_removed(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     ):
         return
 
+    forget_chat_info(accid, chatid)
     contactid = msg.info_contact_id
-    if contactid != SpecialContactId.SELF and len(bot.rpc.get_chat_contacts(accid, chatid)) > 1:
+    if contactid != SpecialContactId.SELF and len(get_chat_contacts(bot, accid, chatid)) > 1:
         return
 
     url = ""
     conid = 0
     chats: list[int] = []
     with session_scope() as session:
-        acc = (
-            session.query(Account)
-            .filter((Account.home == chatid) | (Account.notifications == chatid))
-            .first()
-        )
+        row = session.execute(ACCOUNT_BY_CHAT, {"chatid": chatid}).first()
+        acc = session.get(Account, row.id) if row else None
         if acc:
             url = acc.url
             conid = acc.id
-            chats.extend(dmchat.chat_id for dmchat in acc.dm_chats)
+            forget_mastodon(acc.url, acc.token)
+            chats.extend(session.execute(DMCHATS_BY_ACCOUNT, {"contactid": acc.id}).scalars())
             chats.append(acc.home)
             chats.append(acc.notifications)
             session.delete(acc)
         else:
-            dmchat = session.query(DmChat).filter_by(chat_id=chatid).first()
+            dmchat = session.execute(DMCHAT_BY_CHAT, {"chatid": chatid}).scalar_one_or_none()
             if dmchat:
                 chats.append(chatid)
                 session.delete(dmchat)
             else:
-                hashtags = session.query(Hashtags).filter_by(chat_id=chatid).first()
+                hashtags = session.execute(
+                    HASHTAGS_BY_CHAT, {"chatid": chatid}
+                ).scalar_one_or_none()
                 if hashtags:
                     chats.append(chatid)
                     session.delete(hashtags)
 
-    for chatid in chats:
-        try:
-            bot.rpc.leave_group(accid, chatid)
-        except JsonRpcError:
-            pass
-
-    if url:
-        chatid = bot.rpc.create_chat_by_contact_id(accid, conid)
-        text = f"✔️ You logged out from: {url}"
-        bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+    text = f"✔️ You logged out from: {url}" if url else ""
+    leave_chats(bot, accid, chats, conid, text)
 
 
 @cli.on(events.NewMessage(is_info=False))
@@ -182,17 +210,19 @@ def on_msg(bot: Bot, accid: int, event: NewMsgEvent) -> None:
 
     msg = event.msg
     chatid = msg.chat_id
-    chat = bot.rpc.get_basic_chat_info(accid, chatid)
+    chat = get_chat_info(bot, accid, chatid)
 
     if chat.chat_type == ChatType.SINGLE:
         bot.rpc.markseen_msgs(accid, [msg.id])
         conid = msg.from_id
-        with session_scope() as session:
-            auth = session.query(OAuth).filter_by(id=conid).first()
+        text = "❌ To publish messages you must send them in your Home chat."
+        if conid not in PENDING_OAUTH:
+            bot.rpc.send_msg(accid, chatid, _reply(msg, text))
+            return
+        with read_session() as session:
+            auth = session.get(OAuth, conid)
             if not auth:
-                text = "❌ To publish messages you must send them in your Home chat."
-                reply = MsgData(text=text, quoted_message_id=msg.id)
-                bot.rpc.send_msg(accid, chatid, reply)
+                bot.rpc.send_msg(accid, chatid, _reply(msg, text))
                 return
             url, user, client_id, client_secret = (
                 auth.url,
@@ -203,33 +233,32 @@ def on_msg(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         m = get_mastodon(url, client_id=client_id, client_secret=client_secret)
         try:
             m.log_in(code=msg.text.strip())
-            _login(bot, accid, chatid, conid, user, m)
-            with session_scope() as session:
-                session.delete(session.query(OAuth).filter_by(id=conid).first())
+            _login(bot, accid, chatid, conid, user, m, drop_oauth=True)
+            PENDING_OAUTH.discard(conid)
         except Exception as err:  # noqa
             bot.logger.exception(err)
             text = "❌ Authentication failed, generate another authorization code and send it here"
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
         return
 
+    if chatid not in TOOT_CHATS:
+        return
+
     api_url: str = ""
     token = ""
     args: tuple = ()
-    with session_scope() as session:
-        acc = (
-            session.query(Account)
-            .filter((Account.home == chatid) | (Account.notifications == chatid))
-            .first()
-        )
+    with read_session() as session:
+        acc = session.execute(ACCOUNT_BY_CHAT, {"chatid": chatid}).first()
         if acc:
             if acc.home == chatid:
                 api_url = acc.url
                 token = acc.token
                 args = (msg.text, msg.file)
-        elif len(bot.rpc.get_chat_contacts(accid, chatid)) <= 2:
+        elif len(get_chat_contacts(bot, accid, chatid)) <= 2:
             # only send directly if not in team usage
-            dmchat = session.query(DmChat).filter_by(chat_id=chatid).first()
+            params = {"chatid": chatid}
+            dmchat = session.execute(DMCHAT_ACCOUNT_BY_CHAT, params).scalar_one_or_none()
             if dmchat:
                 api_url = dmchat.account.url
                 token = dmchat.account.token
@@ -240,7 +269,7 @@ def on_msg(bot: Bot, accid: int, event: NewMsgEvent) -> None:
                 )
 
     if api_url:
-        send_toot(get_mastodon(api_url, token), *args)
+        COALESCER.enqueue(bot, (api_url, token), args)
 
 
 @cli.on(events.NewMessage(command="/help"))
@@ -249,6 +278,7 @@ def _help_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
 
 
 @cli.on(events.NewMessage(command="/login"))
+@run_in_executor
 def _login_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
@@ -257,7 +287,7 @@ def _login_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         api_url, email, passwd = args[0], None, None
     else:
         if len(args) != 3:
-            reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+            reply = _reply(msg, WRONG_USAGE)
             bot.rpc.send_msg(accid, chatid, reply)
             return
         api_url, email, passwd = args
@@ -266,7 +296,7 @@ def _login_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
 
     user = ""
     with session_scope() as session:
-        acc = session.query(Account).filter_by(id=conid).first()
+        acc = session.get(Account, conid)
         if acc:
             if acc.url != api_url:
                 text = "❌ You are already logged in."
@@ -284,63 +314,79 @@ def _login_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     else:
         if client_id is None:
             text = "❌ Server doesn't seem to support OAuth."
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
             return
+        stmt = sqlite_insert(OAuth).values(
+            id=conid,
+            url=api_url,
+            user=user,
+            client_id=client_id,
+            client_secret=client_secret,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[OAuth.id],
+            set_={
+                "url": stmt.excluded.url,
+                "user": stmt.excluded.user,
+                "client_id": stmt.excluded.client_id,
+                "client_secret": stmt.excluded.client_secret,
+            },
+        )
         with session_scope() as session:
-            auth = session.query(OAuth).filter_by(id=conid).first()
-            if not auth:
-                session.add(
-                    OAuth(
-                        id=conid,
-                        url=api_url,
-                        user=user,
-                        client_id=client_id,
-                        client_secret=client_secret,
-                    )
-                )
-            else:
-                auth.url = api_url
-                auth.client_id = client_id
-                auth.client_secret = client_secret
-                auth.user = user
+            session.execute(stmt)
+        PENDING_OAUTH.add(conid)
         auth_url = m.auth_request_url()
         text = (
             f"To grant access to your account, open this URL:\n\n{auth_url}\n\n"
             "You will get an authorization code, copy it and send it here"
         )
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, text)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 def _login(
-    bot: Bot, accid: int, chatid: int, conid: int, user: str, masto: mastodon.Mastodon
+    bot: Bot,
+    accid: int,
+    chatid: int,
+    conid: int,
+    user: str,
+    masto: mastodon.Mastodon,
+    drop_oauth: bool = False,
 ) -> None:
+    """Register the logged-in account, dropping the pending OAuth row if drop_oauth is set."""
     uname = masto.me().acct.lower()
 
     if user:
         if user == uname:
-            with session_scope() as session:
-                acc = session.query(Account).filter_by(id=conid).first()
-                acc.token = masto.access_token
-                text = "✔️ You refreshed your credentials."
-                bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+            text = "✔️ You refreshed your credentials."
         else:
             text = "❌ You are already logged in."
-            bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+        with session_scope() as session:
+            if user == uname:
+                acc = session.get(Account, conid)
+                if acc:
+                    acc.token = masto.access_token
+            if drop_oauth:
+                session.execute(delete(OAuth).where(OAuth.id == conid))
+        bot.rpc.send_msg(accid, chatid, MsgData(text=text))
         return
 
-    n = masto.notifications(limit=1)
-    last_notif = n[0].id if n else None
-    n = masto.timeline_home(limit=1)
-    last_home = n[0].id if n else None
+    notif_future = FETCH_POOL.submit(masto.notifications, limit=1)
+    home_future = FETCH_POOL.submit(masto.timeline_home, limit=1)
+    last_notif = _first_id(bot, notif_future)
+    last_home = _first_id(bot, home_future)
 
     api_url = masto.api_base_url
     url = api_url.split("://", maxsplit=1)[-1]
-    hgroup = bot.rpc.create_group_chat(accid, f"Home ({url})", False)
-    ngroup = bot.rpc.create_group_chat(accid, f"Notifications ({url})", False)
-    bot.rpc.add_contact_to_chat(accid, hgroup, conid)
-    bot.rpc.add_contact_to_chat(accid, ngroup, conid)
+    with RpcBatch(bot.rpc) as batch:
+        hgroup_future = batch.create_group_chat(accid, f"Home ({url})", False)
+        ngroup_future = batch.create_group_chat(accid, f"Notifications ({url})", False)
+    hgroup, ngroup = hgroup_future.result(), ngroup_future.result()
+    TOOT_CHATS.add(hgroup)
+    with RpcBatch(bot.rpc) as batch:
+        batch.add_contact_to_chat(accid, hgroup, conid)
+        batch.add_contact_to_chat(accid, ngroup, conid)
 
     with session_scope() as session:
         session.add(
@@ -355,23 +401,36 @@ def _login(
                 last_notif=last_notif,
             )
         )
+        if drop_oauth:
+            session.execute(delete(OAuth).where(OAuth.id == conid))
+
+    with RpcBatch(bot.rpc) as batch:
+        batch.set_chat_profile_image(accid, hgroup, MASTODON_LOGO)
+        batch.set_chat_profile_image(accid, ngroup, MASTODON_LOGO)
 
-    bot.rpc.set_chat_profile_image(accid, hgroup, MASTODON_LOGO)
-    text = (
+    htext = (
         "ℹ️ Messages sent here will be published in"
         f" @{uname}@{url}\n\n"
         "If your Home timeline is too noisy and you would like"
         " to disable incoming toots, send /mute here."
     )
-    bot.rpc.send_msg(accid, hgroup, MsgData(text=text))
-
-    bot.rpc.set_chat_profile_image(accid, ngroup, MASTODON_LOGO)
-    text = (
+    ntext = (
         "ℹ️ Here you will receive notifications for"
         f" @{uname}@{url}\n\n"
         "To mute follows, boosts and favorites, send /mute here."
     )
-    bot.rpc.send_msg(accid, ngroup, MsgData(text=text))
+    with RpcBatch(bot.rpc) as batch:
+        batch.send_msg(accid, hgroup, MsgData(text=htext))
+        batch.send_msg(accid, ngroup, MsgData(text=ntext))
+
+
+def _first_id(bot: Bot, future: Future) -> Optional[str]:
+    try:
+        toots = future.result()
+    except Exception as err:  # noqa
+        bot.logger.exception(err)
+        return None
+    return toots[0].id if toots else None
 
 
 @cli.on(events.NewMessage(command="/logout"))
@@ -380,32 +439,31 @@ def _logout_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     conid = msg.from_id
     chats: list[int] = []
     with session_scope() as session:
-        acc = session.query(Account).filter_by(id=conid).first()
+        acc = session.get(Account, conid)
         if acc:
             text = f"✔️ You logged out from: {acc.url}"
-            chats.extend(dmchat.chat_id for dmchat in acc.dm_chats)
+            forget_mastodon(acc.url, acc.token)
+            chats.extend(session.execute(DMCHATS_BY_ACCOUNT, {"contactid": acc.id}).scalars())
             chats.append(acc.home)
             chats.append(acc.notifications)
             session.delete(acc)
         else:
-            text = "❌ You are not logged in"
+            text = NOT_LOGGED_IN
+        if conid in PENDING_OAUTH:
+            session.execute(delete(OAuth).where(OAuth.id == conid))
+    PENDING_OAUTH.discard(conid)
 
-    for chatid in chats:
-        try:
-            bot.rpc.leave_group(accid, chatid)
-        except JsonRpcError:
-            pass
-    chatid = bot.rpc.create_chat_by_contact_id(accid, conid)
-    bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+    leave_chats(bot, accid, chats, conid, text)
 
 
 @cli.on(events.NewMessage(command="/bio"))
+@run_in_executor
 def _bio_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
 
     if not event.payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -417,19 +475,20 @@ def _bio_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         except mastodon.MastodonAPIError as err:
             text = f"❌ ERROR: {err.args[-1]}"
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
+        text = NOT_LOGGED_IN
+    reply = _reply(msg, text)
     bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/avatar"))
+@run_in_executor
 def _avatar_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
 
     if not msg.file:
         text = "❌ You must send an avatar attached to your message"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, text)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -441,18 +500,19 @@ def _avatar_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         except mastodon.MastodonAPIError:
             text = "❌ Failed to update avatar"
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
+        text = NOT_LOGGED_IN
+    reply = _reply(msg, text)
     bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/dm"))
+@run_in_executor
 def _dm_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
 
     if not event.payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -462,24 +522,26 @@ def _dm_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         user = get_user(masto, username)
         if not user:
             text = f"❌ Account not found: {username}"
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
             return
 
-        chat = bot.rpc.get_basic_chat_info(accid, chatid)
+        chat = get_chat_info(bot, accid, chatid)
         with session_scope() as session:
             acc = get_account_from_msg(chat, msg, session)
             assert acc
-            dmchat = session.query(DmChat).filter_by(contactid=acc.id, contact=user.acct).first()
+            params = {"contactid": acc.id, "contact": user.acct}
+            dmchat = session.execute(DMCHAT_BY_CONTACT, params).scalar_one_or_none()
             if dmchat:
                 text = "❌ Chat already exists, send messages here"
                 bot.rpc.send_msg(accid, dmchat.chat_id, MsgData(text=text))
                 return
             chatid = bot.rpc.create_group_chat(accid, user.acct, False)
-            for conid in bot.rpc.get_chat_contacts(accid, acc.notifications):
+            for conid in get_chat_contacts(bot, accid, cast(int, acc.notifications)):
                 if conid != SpecialContactId.SELF:
                     bot.rpc.add_contact_to_chat(accid, chatid, conid)
             session.add(DmChat(chat_id=chatid, contact=user.acct, contactid=acc.id))
+            TOOT_CHATS.add(chatid)
 
         try:
             with download_file(user.avatar_static, ".jpg") as path:
@@ -489,18 +551,18 @@ def _dm_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         text = f"ℹ️ Private chat with: {user.acct}"
         bot.rpc.send_msg(accid, chatid, MsgData(text=text))
     else:
-        text = "❌ You are not logged in"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, NOT_LOGGED_IN)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/reply"))
+@run_in_executor
 def _reply_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
     args = event.payload.split(maxsplit=1)
     if len(args) != 2 and not (args and msg.file):
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -511,18 +573,18 @@ def _reply_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     if masto:
         send_toot(masto, text=text, filename=msg.file, in_reply_to=toot_id)
     else:
-        text = "❌ You are not logged in"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, NOT_LOGGED_IN)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/star"))
+@run_in_executor
 def _star_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
 
     if not event.payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -530,18 +592,18 @@ def _star_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     if masto:
         masto.status_favourite(event.payload)
     else:
-        text = "❌ You are not logged in"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, NOT_LOGGED_IN)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/boost"))
+@run_in_executor
 def _boost_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
 
     if not event.payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -549,19 +611,19 @@ def _boost_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     if masto:
         masto.status_reblog(event.payload)
     else:
-        text = "❌ You are not logged in"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, NOT_LOGGED_IN)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/open"))
+@run_in_executor
 def _open_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     payload = event.payload
     msg = event.msg
     chatid = msg.chat_id
 
     if not payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -569,189 +631,189 @@ def _open_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     if masto:
         context = masto.status_context(payload)
         toots = context["ancestors"] + [masto.status(payload)] + context["descendants"]
-        text = TOOT_SEP.join(toots2texts(toots)) if toots else "❌ Nothing found"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
-        bot.rpc.send_msg(accid, chatid, reply)
+        _send_toots(bot, accid, msg, toots)
     else:
-        text = "❌ You are not logged in"
-        reply = MsgData(text=text, quoted_message_id=msg.id)
+        reply = _reply(msg, NOT_LOGGED_IN)
         bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/follow"))
+@run_in_executor
 def _follow_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     text = account_action("account_follow", event.payload, bot, accid, msg)
-    reply = MsgData(text=text or "✔️ User followed", quoted_message_id=msg.id)
+    reply = _reply(msg, text or "✔️ User followed")
     bot.rpc.send_msg(accid, msg.chat_id, reply)
 
 
 @cli.on(events.NewMessage(command="/unfollow"))
+@run_in_executor
 def _unfollow_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     text = account_action("account_unfollow", event.payload, bot, accid, msg)
-    reply = MsgData(text=text or "✔️ User unfollowed", quoted_message_id=msg.id)
+    reply = _reply(msg, text or "✔️ User unfollowed")
     bot.rpc.send_msg(accid, msg.chat_id, reply)
 
 
 @cli.on(events.NewMessage(command="/mute"))
+@run_in_executor
 def _mute_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
     if event.payload:
         text = account_action("account_mute", event.payload, bot, accid, msg)
-        reply = MsgData(text=text or "✔️ User muted", quoted_message_id=msg.id)
+        reply = _reply(msg, text or "✔️ User muted")
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
     # check if the message was sent in the Home or Notifications chat
     with session_scope() as session:
-        acc = session.query(Account).filter_by(home=msg.chat_id).first()
-        if acc:
+        row = session.execute(ACCOUNT_BY_CHAT, {"chatid": chatid}).first()
+        acc = session.get(Account, row.id) if row else None
+        if acc and acc.home == chatid:
             acc.muted_home = True
             acc.last_home = None
             text = "✔️ Home timeline muted"
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
             return
 
-        acc = session.query(Account).filter_by(notifications=msg.chat_id).first()
         if acc:
             acc.muted_notif = True
             text = (
                 "✔️ Notifications timeline muted: follows,"
                 " favorites and boosts will not be notified"
             )
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
         else:
             text = (
                 "❌ Wrong usage, you must send that command"
                 " in the Home or Notifications chat to mute them"
             )
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/unmute"))
+@run_in_executor
 def _unmute_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
     if event.payload:
         text = account_action("account_unmute", event.payload, bot, accid, msg)
-        reply = MsgData(text=text or "✔️ User unmuted", quoted_message_id=msg.id)
+        reply = _reply(msg, text or "✔️ User unmuted")
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
     # check if the message was sent in the Home or Notifications chat
     with session_scope() as session:
-        acc = session.query(Account).filter_by(home=msg.chat_id).first()
-        if acc:
+        row = session.execute(ACCOUNT_BY_CHAT, {"chatid": chatid}).first()
+        acc = session.get(Account, row.id) if row else None
+        if acc and acc.home == chatid:
             acc.muted_home = False
             acc.last_home = None
             text = "✔️ Home timeline unmuted"
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
             return
 
-        acc = session.query(Account).filter_by(notifications=msg.chat_id).first()
         if acc:
             acc.muted_notif = False
             text = "✔️ Notifications timeline unmuted"
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
         else:
             text = (
                 "❌ Wrong usage, you must send that command in"
                 " the Home or Notifications chat to unmute them"
             )
-            reply = MsgData(text=text, quoted_message_id=msg.id)
+            reply = _reply(msg, text)
             bot.rpc.send_msg(accid, chatid, reply)
 
 
 @cli.on(events.NewMessage(command="/block"))
+@run_in_executor
 def _block_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     text = account_action("account_block", event.payload, bot, accid, msg)
-    reply = MsgData(text=text or "✔️ User blocked", quoted_message_id=msg.id)
+    reply = _reply(msg, text or "✔️ User blocked")
     bot.rpc.send_msg(accid, msg.chat_id, reply)
 
 
 @cli.on(events.NewMessage(command="/unblock"))
+@run_in_executor
 def _unblock_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     text = account_action("account_unblock", event.payload, bot, accid, msg)
-    reply = MsgData(text=text or "✔️ User unblocked", quoted_message_id=msg.id)
+    reply = _reply(msg, text or "✔️ User unblocked")
     bot.rpc.send_msg(accid, msg.chat_id, reply)
 
 
 @cli.on(events.NewMessage(command="/profile"))
+@run_in_executor
 def _profile_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     masto = get_mastodon_from_msg(bot, accid, msg)
     if masto:
         text = get_profile(masto, event.payload)
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
+        text = NOT_LOGGED_IN
+    reply = _reply(msg, text)
     bot.rpc.send_msg(accid, msg.chat_id, reply)
 
 
 @cli.on(events.NewMessage(command="/local"))
+@run_in_executor
 def _local_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     masto = get_mastodon_from_msg(bot, accid, msg)
     if masto:
-        text = TOOT_SEP.join(toots2texts(reversed(masto.timeline_local()))) or "❌ Nothing found"
+        _send_toots(bot, accid, msg, masto.timeline_local()[::-1])
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
-    bot.rpc.send_msg(accid, msg.chat_id, reply)
+        bot.rpc.send_msg(accid, msg.chat_id, _reply(msg, NOT_LOGGED_IN))
 
 
 @cli.on(events.NewMessage(command="/public"))
+@run_in_executor
 def _public_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     masto = get_mastodon_from_msg(bot, accid, msg)
     if masto:
-        text = TOOT_SEP.join(toots2texts(reversed(masto.timeline_public()))) or "❌ Nothing found"
+        _send_toots(bot, accid, msg, masto.timeline_public()[::-1])
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
-    bot.rpc.send_msg(accid, msg.chat_id, reply)
+        bot.rpc.send_msg(accid, msg.chat_id, _reply(msg, NOT_LOGGED_IN))
 
 
 @cli.on(events.NewMessage(command="/tag"))
+@run_in_executor
 def _tag_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
     payload = event.payload
 
     if not payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
     tag = payload.lstrip("#")
     masto = get_mastodon_from_msg(bot, accid, msg)
     if masto:
-        text = (
-            TOOT_SEP.join(toots2texts(reversed(masto.timeline_hashtag(tag)))) or "❌ Nothing found"
-        )
+        _send_toots(bot, accid, msg, masto.timeline_hashtag(tag)[::-1])
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
-    bot.rpc.send_msg(accid, chatid, reply)
+        bot.rpc.send_msg(accid, chatid, _reply(msg, NOT_LOGGED_IN))
 
 
 @cli.on(events.NewMessage(command="/search"))
+@run_in_executor
 def _search_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
     msg = event.msg
     chatid = msg.chat_id
     payload = event.payload
 
     if not payload:
-        reply = MsgData(text="❌ Wrong usage", quoted_message_id=msg.id)
+        reply = _reply(msg, WRONG_USAGE)
         bot.rpc.send_msg(accid, chatid, reply)
         return
 
@@ -771,13 +833,12 @@ def _search_cmd(bot: Bot, accid: int, event: NewMsgEvent) -> None:
         if not text:
             text = "❌ Nothing found"
     else:
-        text = "❌ You are not logged in"
-    reply = MsgData(text=text, quoted_message_id=msg.id)
+        text = NOT_LOGGED_IN
+    reply = _reply(msg, text)
     bot.rpc.send_msg(accid, chatid, reply)
 
 
-def send_help(bot: Bot, accid: int, chatid: int) -> None:
-    text = """
+HELP_TEXT = """
 Hi, I am a Mastodon bridge bot.
 
 Use /login to log in, once you log in with your Mastodon credentials, two chats will be created for you:
@@ -849,4 +910,7 @@ Use /login to log in, once you log in with your Mastodon credentials, two chats
 /search - Search for users and hashtags matching the given text. Example:
     /search deltachat
     """
-    bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+
+
+def send_help(bot: Bot, accid: int, chatid: int) -> None:
+    bot.rpc.send_msg(accid, chatid, MsgData(text=HELP_TEXT))
@@ -5,25 +5,42 @@ from pathlib import Path
 
 from deltachat2 import Bot
 
-DATABASE_VERSION = 3
+from .orm import set_sqlite_pragmas
+
+DATABASE_VERSION = 4
+COPY_ACCOUNT_V3 = """
+    INSERT INTO account (id, user, url, token, home, notifications,
+                         last_home, last_notif, muted_home, muted_notif)
+    SELECT m.conid, o.user, o.url, o.token, o.home, o.notifications,
+           o.last_home, o.last_notif, o.muted_home, o.muted_notif
+    FROM old_account o JOIN addr_map m ON m.addr = o.addr
+"""
+COPY_DMCHAT_V3 = """
+    INSERT INTO dmchat (chat_id, contactid, contact)
+    SELECT o.chat_id, m.conid, o.contact
+    FROM old_dmchat o JOIN addr_map m ON m.addr = o.acc_addr
+"""
+COPY_OAUTH_V3 = """
+    INSERT INTO oauth (id, url, user, client_id, client_secret)
+    SELECT m.conid, o.url, o.user, o.client_id, o.client_secret
+    FROM old_oauth o JOIN addr_map m ON m.addr = o.addr
+"""
 
 
 def get_db_version(database: sqlite3.Connection) -> int:
-    with database:
-        database.execute(
-            """CREATE TABLE IF NOT EXISTS "database" (
+    database.executescript(
+        f"""
+        BEGIN;
+        CREATE TABLE IF NOT EXISTS "database" (
             "id" INTEGER NOT NULL,
-	    "version" INTEGER NOT NULL,
-	    PRIMARY KEY("id")
-            )"""
-        )
-        row = database.execute("SELECT version FROM database").fetchone()
-        if row:
-            version = row["version"]
-        else:
-            database.execute("REPLACE INTO database VALUES (?,?)", (1, DATABASE_VERSION))
-            version = DATABASE_VERSION
-    return version
+            "version" INTEGER NOT NULL,
+            PRIMARY KEY("id")
+        );
+        INSERT OR IGNORE INTO database VALUES (1, {DATABASE_VERSION});
+        COMMIT;
+        """
+    )
+    return database.execute("SELECT version FROM database WHERE id=1").fetchone()["version"]
 
 
 def run_migrations(bot: Bot, path: Path) -> None:
@@ -33,12 +50,16 @@ def run_migrations(bot: Bot, path: Path) -> None:
 
     database = sqlite3.connect(path)
     database.row_factory = sqlite3.Row
+    set_sqlite_pragmas(database)
+    # these can't be changed inside a transaction: don't check foreign keys while tables
+    # are rebuilt and don't rewrite references to renamed tables
+    database.execute("PRAGMA foreign_keys=OFF")
+    database.execute("PRAGMA legacy_alter_table=ON")
     try:
         version = get_db_version(database)
         bot.logger.debug(f"Current database version: v{version}")
         for i in range(version + 1, DATABASE_VERSION + 1):
-            migration = globals().get(f"migrate{i}")
-            assert migration
+            migration = MIGRATIONS[i - 1]
             bot.logger.info(f"Migrating database: v{i}")
             with database:
                 database.execute("REPLACE INTO database VALUES (?,?)", (1, i))
@@ -61,104 +82,91 @@ def migrate2(_bot: Bot, database: sqlite3.Connection) -> None:
 
 def migrate3(bot: Bot, database: sqlite3.Connection) -> None:
     accid = bot.rpc.get_all_account_ids()[0]
-    with database:
-        database.execute("ALTER TABLE account RENAME TO old_account")
-        database.execute(
-            """
-            CREATE TABLE account (
-                    id INTEGER PRIMARY KEY,
-                    user VARCHAR(1000) NOT NULL,
-                    url VARCHAR(1000) NOT NULL,
-                    token VARCHAR(1000) NOT NULL,
-                    home INTEGER NOT NULL,
-                    notifications INTEGER NOT NULL,
-                    last_home VARCHAR(1000),
-                    last_notif VARCHAR(1000),
-                    muted_home BOOLEAN,
-                    muted_notif BOOLEAN
-            )
-            """
+
+    # the caller already holds the transaction, resolve every address once and let SQLite
+    # copy the tables joining with the mapping, secondary indexes are built at the end
+    cursor = database.cursor()
+    addrs = cursor.execute(
+        "SELECT addr FROM account UNION SELECT acc_addr FROM dmchat UNION SELECT addr FROM oauth"
+    ).fetchall()
+    cursor.execute("CREATE TEMP TABLE addr_map (addr TEXT PRIMARY KEY, conid INTEGER)")
+    cursor.executemany(
+        "INSERT INTO addr_map VALUES (?, ?)",
+        [(addr, bot.rpc.lookup_contact_id_by_addr(accid, addr)) for (addr,) in addrs],
+    )
+
+    cursor.execute("ALTER TABLE account RENAME TO old_account")
+    cursor.execute(
+        """
+        CREATE TABLE account (
+                id INTEGER PRIMARY KEY,
+                user VARCHAR(1000) NOT NULL,
+                url VARCHAR(1000) NOT NULL,
+                token VARCHAR(1000) NOT NULL,
+                home INTEGER NOT NULL,
+                notifications INTEGER NOT NULL,
+                last_home VARCHAR(1000),
+                last_notif VARCHAR(1000),
+                muted_home BOOLEAN,
+                muted_notif BOOLEAN
         )
-        for row in database.execute("SELECT * FROM old_account"):
-            addr = row["addr"]
-            conid = bot.rpc.lookup_contact_id_by_addr(accid, addr)
-            database.execute(
-                (
-                    "INSERT INTO account (id, user, url, token, home, notifications,"
-                    " last_home, last_notif, muted_home, muted_notif)"
-                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                ),
-                (
-                    conid,
-                    row["user"],
-                    row["url"],
-                    row["token"],
-                    row["home"],
-                    row["notifications"],
-                    row["last_home"],
-                    row["last_notif"],
-                    row["muted_home"],
-                    row["muted_notif"],
-                ),
-            )
-        database.execute("DROP TABLE old_account")
-
-        database.execute("ALTER TABLE dmchat RENAME TO old_dmchat")
-        database.execute(
-            """
-            CREATE TABLE dmchat (
-                    chat_id INTEGER PRIMARY KEY,
-                    contact VARCHAR(1000) NOT NULL,
-                    contactid INTEGER NOT NULL,
-                    Foreign KEY(contactid) REFERENCES account (id)
-            )
-            """
+        """
+    )
+    cursor.execute(COPY_ACCOUNT_V3)
+    cursor.execute("DROP TABLE old_account")
+    cursor.execute("CREATE INDEX ix_account_home ON account (home)")
+    cursor.execute("CREATE INDEX ix_account_notifications ON account (notifications)")
+
+    cursor.execute("ALTER TABLE dmchat RENAME TO old_dmchat")
+    cursor.execute(
+        """
+        CREATE TABLE dmchat (
+                chat_id INTEGER PRIMARY KEY,
+                contact VARCHAR(1000) NOT NULL,
+                contactid INTEGER NOT NULL,
+                Foreign KEY(contactid) REFERENCES account (id)
         )
-        for row in database.execute("SELECT * FROM old_dmchat"):
-            addr = row["acc_addr"]
-            conid = bot.rpc.lookup_contact_id_by_addr(accid, addr)
-            database.execute(
-                """
-                INSERT INTO dmchat (chat_id, contactid, contact)
-                VALUES (?, ?, ?)
-                """,
-                (row["chat_id"], conid, row["contact"]),
-            )
-        database.execute("DROP TABLE old_dmchat")
-
-        database.execute("ALTER TABLE oauth RENAME TO old_oauth")
-        database.execute(
-            """
-            CREATE TABLE oauth (
-                    id INTEGER PRIMARY KEY,
-                    url VARCHAR(1000) NOT NULL,
-                    user VARCHAR(1000),
-                    client_id VARCHAR(1000) NOT NULL,
-                    client_secret VARCHAR(1000) NOT NULL
-            )
-            """
+        """
+    )
+    cursor.execute(COPY_DMCHAT_V3)
+    cursor.execute("DROP TABLE old_dmchat")
+    cursor.execute("CREATE INDEX ix_dmchat_contactid ON dmchat (contactid)")
+
+    cursor.execute("ALTER TABLE oauth RENAME TO old_oauth")
+    cursor.execute(
+        """
+        CREATE TABLE oauth (
+                id INTEGER PRIMARY KEY,
+                url VARCHAR(1000) NOT NULL,
+                user VARCHAR(1000),
+                client_id VARCHAR(1000) NOT NULL,
+                client_secret VARCHAR(1000) NOT NULL
         )
-        for row in database.execute("SELECT * FROM old_oauth"):
-            addr = row["addr"]
-            conid = bot.rpc.lookup_contact_id_by_addr(accid, addr)
-            database.execute(
-                """
-                INSERT INTO oauth (id, url, user, client_id, client_secret)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (conid, row["url"], row["user"], row["client_id"], row["client_secret"]),
-            )
-        database.execute("DROP TABLE old_oauth")
-
-
-def migrate4(bot: Bot, database: sqlite3.Connection) -> None:
+        """
+    )
+    cursor.execute(COPY_OAUTH_V3)
+    cursor.execute("DROP TABLE old_oauth")
+    cursor.execute("DROP TABLE addr_map")
+    # the statistics of the old tables are gone with them
+    cursor.execute("ANALYZE")
+
+    for table, rowid, parent, _ in cursor.execute("PRAGMA foreign_key_check"):
+        bot.logger.warning(f"Row {rowid} in {table} references a missing row in {parent}")
+
+
+def migrate4(_bot: Bot, database: sqlite3.Connection) -> None:
     database.execute(
-        """"
-        CREATE TABLE hashtags (
-                    chat_id INTEGER PRIMARY KEY,
-                    contactid INTEGER NOT NULL,
-                    last VARCHAR(1000),
-                    Foreign KEY(contactid) REFERENCES account (id)
-            )
         """
-    )
\ No newline at end of file
+        CREATE TABLE IF NOT EXISTS hashtags (
+                chat_id INTEGER PRIMARY KEY,
+                contactid INTEGER NOT NULL,
+                last VARCHAR(1000),
+                FOREIGN KEY(contactid) REFERENCES account (id)
+        )
+        """
+    )
+
+
+# migration to version N is at index N-1
+MIGRATIONS = (migrate1, migrate2, migrate3, migrate4)
+assert len(MIGRATIONS) == DATABASE_VERSION
@@ -1,57 +1,74 @@
+import atexit
 from contextlib import contextmanager
 from threading import Lock
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, create_engine
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, Text, create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
 Base = declarative_base()
 _Session = sessionmaker()
+# serializes writers, readers don't block each other in WAL mode
 _lock = Lock()
 
 
 class Account(Base):
     __tablename__ = "account"
     id = Column(Integer, primary_key=True)
-    user = Column(String(1000), nullable=False)
-    url = Column(String(1000), nullable=False)
-    token = Column(String(1000), nullable=False)
-    home = Column(Integer, nullable=False)
-    notifications = Column(Integer, nullable=False)
-    last_home = Column(String(1000))
-    last_notif = Column(String(1000))
+    user = Column(Text, nullable=False)
+    url = Column(Text, nullable=False)
+    token = Column(Text, nullable=False)
+    home = Column(Integer, nullable=False, index=True)
+    notifications = Column(Integer, nullable=False, index=True)
+    last_home = Column(Text)
+    last_notif = Column(Text)
     muted_home = Column(Boolean)
     muted_notif = Column(Boolean)
 
-    dm_chats = relationship("DmChat", backref="account", cascade="all, delete, delete-orphan")
+    dm_chats = relationship(
+        "DmChat", back_populates="account", cascade="all, delete, delete-orphan", lazy="raise"
+    )
     hashtags = relationship("Hashtags", backref="account", cascade="all, delete, delete-orphan")
 
 class DmChat(Base):
     __tablename__ = "dmchat"
     chat_id = Column(Integer, primary_key=True)
-    contactid = Column(Integer, ForeignKey("account.id"), nullable=False)
-    contact = Column(String(1000), nullable=False)
+    contactid = Column(Integer, ForeignKey("account.id"), nullable=False, index=True)
+    contact = Column(Text, nullable=False)
+
+    account = relationship("Account", back_populates="dm_chats")
 
 class Hashtags(Base):
     __tablename__ = "hashtags"
     chat_id = Column(Integer, primary_key=True)
-    contactid = Column(Integer, ForeignKey("account.id"), nullable=False)
-    last = Column(String(1000))
+    contactid = Column(Integer, ForeignKey("account.id"), nullable=False, index=True)
+    last = Column(Text)
 
 class OAuth(Base):
     __tablename__ = "oauth"
     id = Column(Integer, primary_key=True)
-    url = Column(String(1000), nullable=False)
-    user = Column(String(1000))
-    client_id = Column(String(1000), nullable=False)
-    client_secret = Column(String(1000), nullable=False)
+    url = Column(Text, nullable=False)
+    user = Column(Text)
+    client_id = Column(Text, nullable=False)
+    client_secret = Column(Text, nullable=False)
 
 
 class Client(Base):
     __tablename__ = "client"
-    url = Column(String(1000), primary_key=True)
-    id = Column(String(1000))
-    secret = Column(String(1000))
+    url = Column(Text, primary_key=True)
+    id = Column(Text)
+    secret = Column(Text)
+
+
+@contextmanager
+def read_session():
+    """Provide a scope around a series of read-only operations."""
+    session = _Session()
+    try:
+        yield session
+    finally:
+        session.close()
 
 
 @contextmanager
@@ -69,8 +86,49 @@ def session_scope():
             session.close()
 
 
+def set_sqlite_pragmas(dbapi_connection, _connection_record=None) -> None:
+    """Tune a new SQLite connection, WAL mode is persisted in the database file."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-32000")
+    cursor.close()
+
+
+def _optimize(engine) -> None:
+    """Refresh the query planner statistics that are out of date, before exiting."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA optimize")
+    engine.dispose()
+
+
 def initdb(path: str, debug: bool = False) -> None:
     """Initialize engine."""
-    engine = create_engine(path, echo=debug)
-    Base.metadata.create_all(engine)
+    if path in ("sqlite://", "sqlite:///:memory:"):
+        # every connection to an in-memory database would get its own empty database
+        pool_args: dict = {"poolclass": StaticPool}
+    else:
+        # enough connections for every worker of workers.EXECUTOR
+        pool_args = {"poolclass": QueuePool, "pool_size": 8, "max_overflow": 24}
+    engine = create_engine(
+        path,
+        echo=debug,
+        future=True,
+        query_cache_size=1200,
+        connect_args={"check_same_thread": False, "timeout": 30},
+        **pool_args,
+    )
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    with engine.connect() as conn:
+        existing = set(conn.exec_driver_sql("SELECT name FROM sqlite_master").scalars())
+    if not set(Base.metadata.tables).issubset(existing):
+        Base.metadata.create_all(engine)
+    # create_all() only creates indexes together with missing tables
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine, checkfirst=True)
     _Session.configure(bind=engine)
+    atexit.register(_optimize, engine)
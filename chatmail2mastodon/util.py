@@ -1,21 +1,25 @@
 """Utilities"""
 
 import functools
+import itertools
 import mimetypes
 import re
+import subprocess
 import time
 from argparse import Namespace
+from concurrent.futures import Future
 from contextlib import contextmanager
 from enum import Enum
 from tempfile import NamedTemporaryFile
+from threading import Lock
 from typing import Any, Dict, Generator, Iterable, List, Optional
 import json
 import random
 
 import requests
 from bs4 import BeautifulSoup
+from cachetools import LRUCache, TTLCache
 from deltachat2 import Bot, ChatType, JsonRpcError, MsgData, SpecialContactId
-from html2text import html2text
 from mastodon import (
     AttribAccessDict,
     Mastodon,
@@ -24,9 +28,23 @@ from mastodon import (
     MastodonUnauthorizedError,
     MastodonRatelimitError
 )
-from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from sqlalchemy import (
+    Select,
+    and_,
+    bindparam,
+    exists,
+    literal,
+    or_,
+    select,
+    union_all,
+    update,
+)
+from sqlalchemy.orm import joinedload
+from urllib3.util import Retry
 
-from .orm import Account, Client, Hashtags, DmChat, session_scope
+from .orm import Account, Client, Hashtags, DmChat, OAuth, read_session, session_scope
+from .workers import FETCH_POOL, POLL_POOL, SEND_POOL, Coalescer, RpcBatch
 
 SPAM = [
     "/fediversechick/",
@@ -35,10 +53,78 @@ SPAM = [
 ]
 MUTED_NOTIFICATIONS = ("reblog", "favourite", "follow")
 TOOT_SEP = "\n\n―――――――――――――――\n\n"
+WRONG_USAGE = "❌ Wrong usage"
+NOT_LOGGED_IN = "❌ You are not logged in"
 STRFORMAT = "%Y-%m-%d %H:%M"
+FILENAME_REGEX = re.compile(r'filename="?([^";]+)"?')
+_account = Account.__table__
+ACCOUNT_BY_CHAT = select(
+    _account.c.id, _account.c.home, _account.c.notifications, _account.c.url, _account.c.token
+).where(
+    or_(_account.c.home == bindparam("chatid"), _account.c.notifications == bindparam("chatid"))
+)
+DMCHAT_BY_CHAT = select(DmChat).where(DmChat.chat_id == bindparam("chatid"))
+# the account is loaded in the same query, for chats that are used to publish
+DMCHAT_ACCOUNT_BY_CHAT = DMCHAT_BY_CHAT.options(joinedload(DmChat.account))
+DMCHAT_BY_CONTACT = select(DmChat).where(
+    DmChat.contactid == bindparam("contactid"), DmChat.contact == bindparam("contact")
+)
+DMCHATS_BY_ACCOUNT: Select = select(DmChat.chat_id).where(
+    DmChat.contactid == bindparam("contactid")
+)
+# any row if the chat is a Home, Notifications or private chat
+BRIDGE_CHAT = union_all(
+    select(literal(1)).where(DmChat.chat_id == bindparam("chatid")),
+    select(literal(1)).where(Account.home == bindparam("chatid")),
+    select(literal(1)).where(Account.notifications == bindparam("chatid")),
+).limit(1)
+# every account is polled, muted timelines are skipped by the poller
+ACCOUNTS_TO_CHECK: Select = select(
+    Account.url,
+    Account.id,
+    Account.token,
+    Account.home,
+    Account.last_home,
+    Account.muted_home,
+    Account.notifications,
+    Account.last_notif,
+    Account.muted_notif,
+)
+_hashtags = Hashtags.__table__
+# progress is only saved if the account wasn't logged out (or in again) meanwhile
+_same_login = and_(
+    _account.c.id == bindparam("conid"), _account.c.token == bindparam("login_token")
+)
+SET_LAST_HOME = update(_account).where(_same_login).values(last_home=bindparam("last_id"))
+SET_LAST_NOTIF = update(_account).where(_same_login).values(last_notif=bindparam("last_id"))
+SET_LAST_HASHTAGS = (
+    update(_hashtags)
+    .where(
+        _hashtags.c.chat_id == bindparam("chatid"),
+        _hashtags.c.contactid == bindparam("conid"),
+        exists().where(_same_login),
+    )
+    .values(last=bindparam("last_id"))
+)
+HASHTAGS_BY_CHAT = select(Hashtags).where(Hashtags.chat_id == bindparam("chatid"))
 _scope = __name__.split(".", maxsplit=1)[0]
 web = requests.Session()
 web.request = functools.partial(web.request, timeout=10)  # type: ignore
+# retry idempotent requests when a server is briefly unavailable, the last response
+# is returned as is so errors are still reported by Mastodon.py
+_retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+web.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=_retry))
+web.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=_retry))
+# Home and private chats, messages sent there are published on Mastodon
+TOOT_CHATS: set[int] = set()
+# contacts with an OAuth login waiting for its authorization code
+PENDING_OAUTH: set[int] = set()
+_chat_info: TTLCache = TTLCache(maxsize=4096, ttl=30)
+_chat_contacts: TTLCache = TTLCache(maxsize=4096, ttl=60)
+_chat_info_lock = Lock()
+# Mastodon clients by (api_url, token), to avoid fetching the instance version again
+_clients: LRUCache = LRUCache(maxsize=512)
+_clients_lock = Lock()
 
 
 class Visibility(str, Enum):
@@ -56,6 +142,60 @@ v2emoji = {
 }
 
 
+def load_toot_chats() -> None:
+    """Load the ids of the chats that publish on Mastodon and of the pending OAuth logins."""
+    with read_session() as session:
+        TOOT_CHATS.update(session.execute(select(Account.home)).scalars())
+        TOOT_CHATS.update(session.execute(select(DmChat.chat_id)).scalars())
+        PENDING_OAUTH.update(session.execute(select(OAuth.id)).scalars())
+
+
+def get_chat_info(bot: Bot, accid: int, chatid: int) -> Any:
+    """Get the basic info of the given chat, cached for a short time."""
+    key = (accid, chatid)
+    with _chat_info_lock:
+        info = _chat_info.get(key)
+    if info is None:
+        info = bot.rpc.get_basic_chat_info(accid, chatid)
+        with _chat_info_lock:
+            _chat_info[key] = info
+    return info
+
+
+def get_chat_contacts(bot: Bot, accid: int, chatid: int) -> tuple[int, ...]:
+    """Get the ids of the members of the given chat, cached for a short time."""
+    key = (accid, chatid)
+    with _chat_info_lock:
+        contacts = _chat_contacts.get(key)
+    if contacts is None:
+        contacts = tuple(bot.rpc.get_chat_contacts(accid, chatid))
+        with _chat_info_lock:
+            _chat_contacts[key] = contacts
+    return contacts
+
+
+def forget_chat_info(accid: int, chatid: int) -> None:
+    """Drop the cached info and members of the given chat."""
+    with _chat_info_lock:
+        _chat_info.pop((accid, chatid), None)
+        _chat_contacts.pop((accid, chatid), None)
+
+
+def leave_chats(bot: Bot, accid: int, chats: list[int], conid: int = 0, text: str = "") -> None:
+    """Leave the given groups after their rows were deleted.
+
+    If text is given, it is sent to the contact with the given id in its 1:1 chat.
+    """
+    TOOT_CHATS.difference_update(chats)
+    with RpcBatch(bot.rpc, ignore=JsonRpcError) as batch:
+        for chatid in chats:
+            batch.leave_group(accid, chatid)
+        if text:
+            chat_future = batch.create_chat_by_contact_id(accid, conid)
+    if text:
+        bot.rpc.send_msg(accid, chat_future.result(), MsgData(text=text))
+
+
 def toots2texts(toots: Iterable) -> Generator[str, None, None]:
     for toot in toots:
         reply = toot2reply(toot)
@@ -71,6 +211,41 @@ def toots2texts(toots: Iterable) -> Generator[str, None, None]:
             yield text
 
 
+def iter_chunks(
+    texts: Iterable[str], max_bytes: int = 4000, sep: str = TOOT_SEP
+) -> Generator[str, None, None]:
+    """Join the given texts with sep into chunks of up to max_bytes of UTF-8.
+
+    A text that doesn't fit alone in a chunk is yielded as its own chunk.
+    """
+    sep_size = len(sep.encode())
+    chunk: list[str] = []
+    size = 0
+    for text in texts:
+        text_size = len(text.encode())
+        if chunk and size + sep_size + text_size > max_bytes:
+            yield sep.join(chunk)
+            chunk, size = [], 0
+        size += text_size + (sep_size if chunk else 0)
+        chunk.append(text)
+    if chunk:
+        yield sep.join(chunk)
+
+
+def send_replies(bot: Bot, accid: int, chatid: int, replies: Iterable[MsgData]) -> Future:
+    """Send the replies to the given chat in order, in the background.
+
+    The replies are also generated in the worker, so temporary files of toots2replies()
+    are kept until their message is sent.
+    """
+
+    def _send() -> None:
+        for reply in replies:
+            bot.rpc.send_msg(accid, chatid, reply)
+
+    return SEND_POOL.submit(_send)
+
+
 def toots2replies(bot: Bot, toots: Iterable) -> Generator:
     for toot in toots:
         reply = toot2reply(toot)
@@ -108,18 +283,8 @@ def toot2reply(toot: AttribAccessDict) -> MsgData:
         text += f"[{first.description or 'no alt'}]\n\n"
         text += "\n\n".join(f"{media.url}\n[{media.description or 'no alt'}]" for media in toot.media_attachments) + "\n\n"
 
-    soup = BeautifulSoup(toot.content, "html.parser")
-    if toot.mentions:
-        accts = {e.url: "@" + e.acct for e in toot.mentions}
-        for anchor in soup("a", class_="u-url"):
-            name = accts.get(anchor["href"], "")
-            if name:
-                anchor.string = name
-    for linebreak in soup("br"):
-        linebreak.replace_with("\n")
-    for paragraph in soup("p"):
-        paragraph.replace_with(paragraph.get_text() + "\n\n")
-    text += soup.get_text()
+    accts = {e.url: "@" + e.acct for e in toot.mentions}
+    text += _soup_text(BeautifulSoup(toot.content, "lxml"), accts)
 
     text += f"\n\n[{v2emoji[toot.visibility]} {toot.created_at.strftime(STRFORMAT)}]({toot.url})\n"
     text += f"↩️ /reply_{toot.id}\n"
@@ -155,16 +320,20 @@ def notif2reply(toots: list[AttribAccessDict]) -> Optional[MsgData]:
         return None
 
     toot = toots[0].status
+    content = _html_to_text(toot.content)
+    if content:
+        text += f"\n\n{content}"
     text += f"\n\n[{v2emoji[toot.visibility]} {toot.created_at.strftime(STRFORMAT)}]({toot.url})"
-    return MsgData(text=text, html=toot.content)
+    return MsgData(text=text)
 
 
 def get_extension(resp: requests.Response) -> str:
     disp = resp.headers.get("content-disposition")
-    if disp is not None and re.findall("filename=(.+)", disp):
-        fname = re.findall("filename=(.+)", disp)[0].strip('"')
+    match = FILENAME_REGEX.search(disp) if disp else None
+    if match:
+        fname = match.group(1).strip()
     else:
-        fname = resp.url.split("/")[-1].split("?")[0].split("#")[0]
+        fname = resp.url.rsplit("/", 1)[-1].split("?", 1)[0].split("#", 1)[0]
     if "." in fname:
         ext = "." + fname.rsplit(".", maxsplit=1)[-1]
     else:
@@ -190,11 +359,12 @@ def get_user(m, user_id) -> Any:
 @contextmanager
 def download_file(url: str, default_extension="") -> Generator[str, None, None]:
     """Download a blob and save it in temporary file."""
-    with web.get(url) as resp:
-        ext = get_extension(resp) or default_extension
-        content = resp.content
-    with NamedTemporaryFile(suffix=ext) as temp_file:
-        temp_file.write(content)
+    with (
+        web.get(url, stream=True) as resp,
+        NamedTemporaryFile(suffix=get_extension(resp) or default_extension) as temp_file,
+    ):
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            temp_file.write(chunk)
         temp_file.flush()
         try:
             yield temp_file.name
@@ -210,6 +380,25 @@ def normalize_url(url: str) -> str:
     return url.rstrip("/")
 
 
+def _soup_text(soup: BeautifulSoup, accts: Optional[dict] = None) -> str:
+    """Get the text of the soup, replacing mention links with the given account names."""
+    # a single walk, in reverse so the content of a paragraph is done before the paragraph
+    for tag in reversed(soup.find_all(["a", "br", "p"])):
+        if tag.name == "br":
+            tag.replace_with("\n")
+        elif tag.name == "p":
+            tag.replace_with(tag.get_text() + "\n\n")
+        elif accts and "u-url" in (tag.get("class") or []):
+            name = accts.get(tag.get("href"), "")
+            if name:
+                tag.string = name
+    return soup.get_text()
+
+
+def _html_to_text(html: str) -> str:
+    return _soup_text(BeautifulSoup(html, "lxml")).strip() if html else ""
+
+
 def get_profile(masto: Mastodon, username: Optional[str] = None) -> str:
     me = masto.me()
     if not username:
@@ -222,10 +411,10 @@ def get_profile(masto: Mastodon, username: Optional[str] = None) -> str:
     text = f"{_get_name(user)}:\n\n"
     fields = ""
     for f in user.fields:
-        fields += f"{html2text(f.name).strip()}: {html2text(f.value).strip()}\n"
+        fields += f"{_html_to_text(f.name)}: {_html_to_text(f.value)}\n"
     if fields:
         text += fields + "\n\n"
-    text += html2text(user.note).strip()
+    text += _html_to_text(user.note)
     text += (
         f"\n\nToots: {user.statuses_count}\n"
         f"Following: {user.following_count}\n"
@@ -254,6 +443,43 @@ def get_profile(masto: Mastodon, username: Optional[str] = None) -> str:
     return text
 
 
+class LastIds:
+    """The newest ids seen while checking an instance, saved together once it is done."""
+
+    def __init__(self) -> None:
+        # each instance is only checked by one thread, no lock needed
+        self.tokens: dict[int, str] = {}
+        self.home: dict[int, str] = {}
+        self.notif: dict[int, str] = {}
+        # chat id -> (contact id, last ids)
+        self.hashtags: dict[int, tuple[int, str]] = {}
+
+    def save(self) -> None:
+        tokens = self.tokens
+        home = [
+            {"conid": conid, "login_token": tokens[conid], "last_id": last}
+            for conid, last in self.home.items()
+        ]
+        notif = [
+            {"conid": conid, "login_token": tokens[conid], "last_id": last}
+            for conid, last in self.notif.items()
+        ]
+        hashtags = [
+            {"chatid": chatid, "conid": conid, "login_token": tokens[conid], "last_id": last}
+            for chatid, (conid, last) in self.hashtags.items()
+        ]
+        if not (home or notif or hashtags):
+            return
+        with session_scope() as session:
+            for stmt, params in (
+                (SET_LAST_HOME, home),
+                (SET_LAST_NOTIF, notif),
+                (SET_LAST_HASHTAGS, hashtags),
+            ):
+                if params:
+                    session.execute(stmt, params)
+
+
 def listen_to_mastodon(bot: Bot, args: Namespace) -> None:
     while True:
         try:
@@ -267,92 +493,109 @@ def _check_mastodon(bot: Bot, args: Namespace) -> None:
     while True:
         bot.logger.debug("Checking Mastodon")
         instances: dict = {}
-        with session_scope() as session:
-            acc_count = session.query(Account).count()
-            bot.logger.debug(f"Accounts to check: {acc_count}")
-            for acc in session.query(Account):
-                instances.setdefault(acc.url, []).append(
-                    (
-                        acc.id,
-                        acc.token,
-                        acc.home,
-                        acc.last_home,
-                        acc.muted_home,
-                        acc.notifications,
-                        acc.last_notif,
-                        acc.muted_notif,
-                    )
-                )
+        acc_count = 0
+        with read_session() as session:
+            for url, *fields in session.execute(ACCOUNTS_TO_CHECK):
+                instances.setdefault(url, []).append(tuple(fields))
+                acc_count += 1
+        bot.logger.debug(f"Accounts to check: {acc_count}")
 
         start_time = time.time()
-        instances_count = len(instances)
-        total_acc = acc_count
-        while instances:
-            bot.logger.debug(
-                f"Check: {acc_count} accounts across {instances_count} instances remaining..."
-            )
-            for key in list(instances.keys()):
-                (
-                    conid,
-                    token,
-                    home_chat,
-                    last_home,
-                    muted_home,
-                    notif_chat,
-                    last_notif,
-                    muted_notif,
-                ) = instances[key].pop()
-                acc_count -= 1
-                if not instances[key]:
-                    instances.pop(key)
-                    instances_count -= 1
-                bot.logger.debug(f"contactid={conid}: Checking account ({key})")
-                try:
-                    masto = get_mastodon(key, token)
-                    _check_notifications(
-                        bot, accid, masto, conid, notif_chat, last_notif, muted_notif
-                    )
-                    if muted_home:
-                        bot.logger.debug(f"contactid={conid}: Ignoring Home timeline (muted)")
-                    else:
-                        _check_home(bot, accid, masto, conid, home_chat, last_home, muted_home)
-
-                    _check_hashtags(bot, accid, masto, conid)
-
-                    bot.logger.debug(f"contactid={conid}: Done checking account")
-                except MastodonUnauthorizedError as ex:
-                    bot.logger.exception(ex)
-                    chats: List[int] = []
-                    with session_scope() as session:
-                        acc = session.query(Account).filter_by(id=conid).first()
-                        if acc:
-                            chats.extend(dmchat.chat_id for dmchat in acc.dm_chats)
-                            chats.append(acc.home)
-                            chats.append(acc.notifications)
-                            session.delete(acc)
-                    for chat_id in chats:
-                        try:
-                            bot.rpc.leave_group(accid, chat_id)
-                        except JsonRpcError:
-                            pass
-
-                    chatid = bot.rpc.create_chat_by_contact_id(accid, conid)
-                    text = f"❌ ERROR Your account was logged out: {ex}"
-                    bot.rpc.send_msg(accid, chatid, MsgData(text=text))
-                except (MastodonNetworkError, MastodonServerError, MastodonRatelimitError) as ex:
-                    bot.logger.exception(ex)
-                except Exception as ex:  # noqa
-                    bot.logger.exception(ex)
-                    chatid = bot.rpc.create_chat_by_contact_id(accid, conid)
-                    text = f"❌ ERROR while checking your account: {ex}"
-                    bot.rpc.send_msg(accid, chatid, MsgData(text=text))
-            time.sleep(2)
+        # instances are checked in parallel, the accounts of each instance one at a time
+        futures = [
+            POLL_POOL.submit(_check_instance, bot, accid, url, accounts)
+            for url, accounts in instances.items()
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as ex:  # noqa
+                bot.logger.exception(ex)
         elapsed = int(time.time() - start_time)
         delay = max(args.interval - elapsed, 10)
-        bot.logger.info(f"Done checking {total_acc} accounts, sleeping for {delay} seconds...")
+        bot.logger.info(f"Done checking {acc_count} accounts, sleeping for {delay} seconds...")
         time.sleep(delay)
 
 
+def _check_instance(bot: Bot, accid: int, url: str, accounts: list) -> None:
+    bot.logger.debug(f"Check: {len(accounts)} accounts in {url}")
+    last_ids = LastIds()
+    busy = False
+    for account in accounts:
+        # only give the server a break after an account that had something new
+        if busy:
+            time.sleep(2)
+        busy = _check_account(bot, accid, last_ids, url, *account)
+    last_ids.save()
+
+
+def _check_account(
+    bot: Bot,
+    accid: int,
+    last_ids: LastIds,
+    url: str,
+    conid: int,
+    token: str,
+    home_chat: int,
+    last_home: Optional[str],
+    muted_home: bool,
+    notif_chat: int,
+    last_notif: Optional[str],
+    muted_notif: bool,
+) -> bool:
+    """Check the given account, return True if there was anything new or it failed."""
+    bot.logger.debug(f"contactid={conid}: Checking account ({url})")
+    last_ids.tokens[conid] = token
+    sends: list[Future] = []
+    try:
+        masto = get_mastodon(url, token)
+        try:
+            # messages are sent to each chat while the next timeline is fetched
+            sends += _check_notifications(
+                bot, accid, masto, conid, notif_chat, last_notif, muted_notif, last_ids
+            )
+            if muted_home:
+                bot.logger.debug(f"contactid={conid}: Ignoring Home timeline (muted)")
+            else:
+                sends += _check_home(bot, accid, masto, conid, home_chat, last_home, last_ids)
+
+            sends += _check_hashtags(bot, accid, masto, conid, last_ids)
+        finally:
+            # queued sends must be done before the chats are left or an error is reported
+            _wait_sends(bot, sends)
+
+        bot.logger.debug(f"contactid={conid}: Done checking account")
+        return bool(sends) or conid in last_ids.notif
+    except MastodonUnauthorizedError as ex:
+        bot.logger.exception(ex)
+        forget_mastodon(url, token)
+        chats: List[int] = []
+        with session_scope() as session:
+            acc = session.get(Account, conid)
+            if acc:
+                params = {"contactid": acc.id}
+                chats.extend(session.execute(DMCHATS_BY_ACCOUNT, params).scalars())
+                chats.append(acc.home)
+                chats.append(acc.notifications)
+                session.delete(acc)
+        text = f"❌ ERROR Your account was logged out: {ex}"
+        leave_chats(bot, accid, chats, conid, text)
+    except (MastodonNetworkError, MastodonServerError, MastodonRatelimitError) as ex:
+        bot.logger.exception(ex)
+    except Exception as ex:  # noqa
+        bot.logger.exception(ex)
+        chatid = bot.rpc.create_chat_by_contact_id(accid, conid)
+        text = f"❌ ERROR while checking your account: {ex}"
+        bot.rpc.send_msg(accid, chatid, MsgData(text=text))
+    return True
+
+
+def _wait_sends(bot: Bot, sends: list[Future]) -> None:
+    for future in sends:
+        if ex := future.exception():
+            bot.logger.exception(ex, exc_info=ex)
+
+
 def send_toot(
     masto: Mastodon,
     text: Optional[str] = None,
@@ -360,27 +603,44 @@ def send_toot(
     visibility: Optional[str] = None,
     in_reply_to: Optional[str] = None,
 ) -> None:
+    if not filename and not text:
+        return
+    # the replied status is needed for its mentions, visibility and CW,
+    # fetch it while the media is converted and uploaded
+    reply_to = FETCH_POOL.submit(masto.status, in_reply_to) if in_reply_to else None
     if filename:
         if filename.endswith(".aac"):
-            aac_file = AudioSegment.from_file(filename, "aac")
-            filename = filename[:-4] + ".mp3"
-            aac_file.export(filename, format="mp3")
-        media = [masto.media_post(filename).id]
-        if in_reply_to:
-            masto.status_reply(
-                masto.status(in_reply_to), text, media_ids=media, visibility=visibility
+            mp3_file = filename[:-4] + ".mp3"
+            subprocess.run(
+                ["ffmpeg", "-y", "-i", filename]
+                + ["-codec:a", "libmp3lame", "-qscale:a", "4", mp3_file],
+                check=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
             )
+            filename = mp3_file
+        media = [masto.media_post(filename).id]
+        if reply_to:
+            masto.status_reply(reply_to.result(), text, media_ids=media, visibility=visibility)
         else:
             masto.status_post(text, media_ids=media, visibility=visibility)
-    elif text:
-        if in_reply_to:
-            masto.status_reply(masto.status(in_reply_to), text, visibility=visibility)
-        else:
-            masto.status_post(text, visibility=visibility)
+    elif reply_to:
+        masto.status_reply(reply_to.result(), text, visibility=visibility)
+    else:
+        masto.status_post(text, visibility=visibility)
+
+
+def _publish(api_url: str, token: str, *args) -> None:
+    send_toot(get_mastodon(api_url, token), *args)
+
+
+# toots of the same account are published back-to-back, reusing its client
+COALESCER = Coalescer(_publish)
 
 
 def get_client(session, api_url) -> tuple:
-    client = session.query(Client).filter_by(url=api_url).first()
+    client = session.get(Client, api_url)
     if client:
         return client.id, client.secret
 
@@ -399,6 +659,27 @@ def get_client(session, api_url) -> tuple:
 
 
 def get_mastodon(api_url: str, token: Optional[str] = None, **kwargs) -> Mastodon:
+    if not token or kwargs:
+        # login flows set the token on the client, don't share it
+        return _new_mastodon(api_url, token, **kwargs)
+
+    key = (api_url, token)
+    with _clients_lock:
+        masto = _clients.get(key)
+    if masto is None:
+        masto = _new_mastodon(api_url, token)
+        with _clients_lock:
+            _clients[key] = masto
+    return masto
+
+
+def forget_mastodon(api_url: str, token: str) -> None:
+    """Drop the cached client for the given account."""
+    with _clients_lock:
+        _clients.pop((api_url, token), None)
+
+
+def _new_mastodon(api_url: str, token: Optional[str] = None, **kwargs) -> Mastodon:
     return Mastodon(
         access_token=token,
         api_base_url=api_url,
@@ -410,8 +691,8 @@ def get_mastodon(api_url: str, token: Optional[str] = None, **kwargs) -> Mastodo
 
 def get_mastodon_from_msg(bot, accid, msg) -> Optional[Mastodon]:
     api_url, token = "", ""
-    chat = bot.rpc.get_basic_chat_info(accid, msg.chat_id)
-    with session_scope() as session:
+    chat = get_chat_info(bot, accid, msg.chat_id)
+    with read_session() as session:
         acc = get_account_from_msg(chat, msg, session)
         if acc:
             api_url, token = acc.url, acc.token
@@ -421,7 +702,7 @@ def get_mastodon_from_msg(bot, accid, msg) -> Optional[Mastodon]:
 def get_account_from_msg(chat, msg, session) -> Optional[Account]:
     acc = get_account_from_chat(chat, session)
     if not acc:
-        acc = session.query(Account).filter_by(id=msg.from_id).first()
+        acc = session.get(Account, msg.from_id)
     return acc
 
 
@@ -435,7 +716,7 @@ def get_account_from_chat(chat, session) -> Optional[Account]:
         .first()
     )
     if not acc:
-        dmchat = session.query(DmChat).filter_by(chat_id=chat.id).first()
+        dmchat = session.execute(DMCHAT_ACCOUNT_BY_CHAT, {"chatid": chat.id}).scalar_one_or_none()
         if dmchat:
             acc = dmchat.account
     return acc
@@ -443,7 +724,7 @@ def get_account_from_chat(chat, session) -> Optional[Account]:
 
 def account_action(action: str, payload: str, bot, accid, msg) -> str:
     if not payload:
-        return "❌ Wrong usage"
+        return WRONG_USAGE
 
     masto = get_mastodon_from_msg(bot, accid, msg)
     if masto:
@@ -455,20 +736,26 @@ def account_action(action: str, payload: str, bot, accid, msg) -> str:
                 return "❌ Invalid user"
         getattr(masto, action)(user_id)
         return ""
-    return "❌ You are not logged in"
+    return NOT_LOGGED_IN
 
 
 def _get_name(macc) -> str:
-    isbot = "[BOT] " if macc.bot else ""
-    if macc.display_name:
-        return isbot + f"{macc.display_name} (@{macc.acct})"
-    return isbot + macc.acct
+    return _format_name(macc.acct, macc.display_name, bool(macc.bot))
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_name(acct: str, display_name: str, isbot: bool) -> str:
+    prefix = "[BOT] " if isbot else ""
+    if display_name:
+        return prefix + f"{display_name} (@{acct})"
+    return prefix + acct
 
 
 def _handle_dms(bot: Bot, accid: int, dms: list, conid: int, notif_chat: int) -> None:
     def _get_chat_id(acct) -> int:
-        with session_scope() as session:
-            dmchat = session.query(DmChat).filter_by(contactid=conid, contact=acct).first()
+        with read_session() as session:
+            params = {"contactid": conid, "contact": acct}
+            dmchat = session.execute(DMCHAT_BY_CONTACT, params).scalar_one_or_none()
             if dmchat:
                 chat_id = dmchat.chat_id
             else:
@@ -484,12 +771,13 @@ def _handle_dms(bot: Bot, accid: int, dms: list, conid: int, notif_chat: int) ->
         if not chat_id:
             chat_id = bot.rpc.create_group_chat(accid, acct, False)
             chats[acct] = chat_id
-            for cid in bot.rpc.get_chat_contacts(accid, notif_chat):
+            for cid in get_chat_contacts(bot, accid, notif_chat):
                 if cid != SpecialContactId.SELF:
                     bot.rpc.add_contact_to_chat(accid, chat_id, cid)
 
             with session_scope() as session:
                 session.add(DmChat(chat_id=chat_id, contact=acct, contactid=conid))
+            TOOT_CHATS.add(chat_id)
 
             try:
                 url = dm.account.avatar_static
@@ -505,7 +793,7 @@ def _handle_dms(bot: Bot, accid: int, dms: list, conid: int, notif_chat: int) ->
         reply = toot2reply(dm)
         if reply.file:
             try:
-                with download_file(bot, reply.file) as path:
+                with download_file(reply.file) as path:
                     reply.file = path
                     send_reply(dm, reply)
                     continue
@@ -525,17 +813,16 @@ def _check_notifications(
     masto: Mastodon,
     conid: int,
     notif_chat: int,
-    last_id: str,
+    last_id: Optional[str],
     muted_notif: bool,
-) -> None:
+    last_ids: LastIds,
+) -> list[Future]:
     dms = []
     notifications = []
     bot.logger.debug(f"contactid={conid}: Getting Notifications (last_id={last_id})")
     toots = masto.notifications(min_id=last_id, limit=100)
     if toots:
-        with session_scope() as session:
-            acc = session.query(Account).filter_by(id=conid).first()
-            acc.last_notif = last_id = toots[0].id
+        last_ids.notif[conid] = last_id = toots[0].id
         for toot in toots:
             if (
                 toot.type == "mention"
@@ -573,34 +860,49 @@ def _check_notifications(
         if follows:
             notifs.append(follows)
 
-        for reply in notif2replies(notifs):
-            bot.rpc.send_msg(accid, notif_chat, reply)
-        for reply in toots2replies(bot, mentions):
-            bot.rpc.send_msg(accid, notif_chat, reply)
+        replies = itertools.chain(notif2replies(notifs), toots2replies(bot, mentions))
+        return [send_replies(bot, accid, notif_chat, replies)]
+    return []
 
 
 def _check_home(
-    bot: Bot, accid: int, masto: Mastodon, conid: int, home_chat: int, last_id: str, muted_home: bool
-) -> None:
+    bot: Bot,
+    accid: int,
+    masto: Mastodon,
+    conid: int,
+    home_chat: int,
+    last_id: Optional[str],
+    last_ids: LastIds,
+) -> list[Future]:
     me = masto.me()
     bot.logger.debug(f"contactid={conid}: Getting Home timeline (last_id={last_id})")
     toots = masto.timeline_home(min_id=last_id, limit=100)
     if toots:
-        with session_scope() as session:
-            acc = session.query(Account).filter_by(id=conid).first()
-            acc.last_home = last_id = toots[0].id
-        toots = [toot for toot in toots if me.id not in [acc.id for acc in toot.mentions]]
+        last_ids.home[conid] = last_id = toots[0].id
+        toots = [toot for toot in toots if not any(acc.id == me.id for acc in toot.mentions)]
 
     bot.logger.debug(f"contactid={conid}: Home: {len(toots)} new entries (last_id={last_id})")
     if toots:
-	    for reply in toots2replies(bot, reversed(toots)):
-	        bot.rpc.send_msg(accid, home_chat, reply)
+        return [send_replies(bot, accid, home_chat, toots2replies(bot, reversed(toots)))]
+    return []
+
+
+def _toot_date(toot) -> Any:
+    return toot.edited_at or toot.created_at
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_lasts(last: Optional[str]) -> dict:
+    """Parse the last ids of a hashtags chat, the result is shared and must not be modified."""
+    return json.loads(last) if last else {}
+
 
 def _check_hashtags(
-    bot: Bot, accid: int, masto: Mastodon, conid: int
-) -> None:
+    bot: Bot, accid: int, masto: Mastodon, conid: int, last_ids: LastIds
+) -> list[Future]:
+    sends = []
     chats = []
-    with session_scope() as session:
+    with read_session() as session:
         hashtags_chats = session.query(Hashtags).filter_by(contactid=conid)
         for chat in hashtags_chats:
             chats.append((chat.last, chat.chat_id))
@@ -608,25 +910,32 @@ def _check_hashtags(
     # Randomize chats to have a chance to check them all in case of throttling
     for (last, chat_id) in random.sample(chats, k=len(chats)):
         toots = []
-        info = bot.rpc.get_basic_chat_info(accid, chat_id)
+        seen: set[str] = set()
+        info = get_chat_info(bot, accid, chat_id)
         tags = [tag for tag in re.split(r'\W+', info.name) if tag != '']
         bot.logger.debug(f"contactid={conid}: Getting {len(tags)} hashtag timelines in {len(chats)} chats")
 
-        lasts = json.loads(last if last else "{}")
+        lasts = _parse_lasts(last)
         newlasts = {}
 
-        for tag in tags:
-            t = masto.timeline_hashtag(tag, min_id=lasts.get(tag), limit=100)
-            toots.extend([tt for tt in t if tt.id not in [to.id for to in toots]]) # Remove duplicates
+        # fetch all timelines at once, but merge them in the order of the tags
+        futures = [
+            FETCH_POOL.submit(masto.timeline_hashtag, tag, min_id=lasts.get(tag), limit=100)
+            for tag in tags
+        ]
+        for tag, future in zip(tags, futures):
+            t = future.result()
+            toots.extend(tt for tt in t if tt.id not in seen)  # Remove duplicates
+            seen.update(tt.id for tt in t)
             newlasts[tag] = t[0].id if t else lasts.get(tag)
 
         # re-sort
-        toots.sort(key=lambda s: s.edited_at if s.edited_at else s.created_at)
+        toots.sort(key=_toot_date)
 
         bot.logger.debug(f"{len(toots)} toots matching {info.name}")
-        for reply in toots2replies(bot, reversed(toots)):
-            bot.rpc.send_msg(accid, chat_id, reply)
+        if toots:
+            sends.append(send_replies(bot, accid, chat_id, toots2replies(bot, reversed(toots))))
 
-        with session_scope() as session:
-            chat = session.query(Hashtags).filter_by(chat_id=chat_id).first()
-            chat.last = json.dumps(newlasts)
+        if newlasts != lasts:
+            last_ids.hashtags[chat_id] = (conid, json.dumps(newlasts))
+    return sends
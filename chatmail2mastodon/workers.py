@@ -0,0 +1,123 @@
+"""Thread pools and helpers to batch blocking work"""
+
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Timer
+from typing import Any, Callable
+
+from deltachat2 import Bot, Rpc
+
+_scope = __name__.split(".", maxsplit=1)[0]
+# worker pool for handlers blocking on Mastodon requests
+EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix=_scope)
+_rpc_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"{_scope}-rpc")
+# one worker per Mastodon instance being polled
+POLL_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix=f"{_scope}-poll")
+SEND_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"{_scope}-send")
+FETCH_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix=f"{_scope}-fetch")
+
+
+class RpcBatch:
+    """Queue independent JSON-RPC calls and run them concurrently when the block exits.
+
+    Each queued call runs on a thread of an 8-worker pool, so calls in the same batch
+    run in no particular order, don't batch calls that depend on each other. The first
+    error not listed in `ignore` is raised once all calls finished.
+    """
+
+    def __init__(self, rpc: Rpc, ignore: tuple = ()) -> None:
+        self.rpc = rpc
+        self.ignore = ignore
+        self._calls: list[tuple[Future, str, tuple]] = []
+
+    def __getattr__(self, name: str) -> Callable[..., Future]:
+        def _queue(*args) -> Future:
+            future: Future = Future()
+            self._calls.append((future, name, args))
+            return future
+
+        return _queue
+
+    def __enter__(self) -> "RpcBatch":
+        return self
+
+    def __exit__(self, exc_type, _exc, _tb) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def flush(self) -> None:
+        """Run the queued calls and wait until all of them finished."""
+        calls, self._calls = self._calls, []
+        for call in calls:
+            _rpc_pool.submit(self._call, *call)
+        errors = [future.exception() for future, _, _ in calls]
+        for ex in errors:
+            if ex and not isinstance(ex, self.ignore):
+                raise ex
+
+    def _call(self, future: Future, name: str, args: tuple) -> None:
+        try:
+            future.set_result(getattr(self.rpc, name)(*args))
+        except Exception as ex:  # noqa
+            future.set_exception(ex)
+
+
+def submit(bot: Bot, func: Callable, *args) -> Future:
+    """Run func in the worker pool, logging any exception it raises."""
+    future = EXECUTOR.submit(func, *args)
+    future.add_done_callback(functools.partial(_log_failure, bot))
+    return future
+
+
+def run_in_executor(func: Callable) -> Callable:
+    """Decorator to process an event in the worker pool instead of the event loop."""
+
+    @functools.wraps(func)
+    def wrapper(bot: Bot, accid: int, event: Any) -> None:
+        submit(bot, func, bot, accid, event)
+
+    return wrapper
+
+
+def _log_failure(bot: Bot, future: Future) -> None:
+    if ex := future.exception():
+        bot.logger.exception(ex, exc_info=ex)
+
+
+class Coalescer:
+    """Run queued calls in order, with a single worker per key.
+
+    Calls queued for the same key within `delay` seconds are run back-to-back by one
+    thread, e.g. the toots of an account reuse its client and keep-alive connection.
+    """
+
+    def __init__(self, func: Callable[..., None], delay: float = 0.05) -> None:
+        self.func = func
+        self.delay = delay
+        self._pending: dict[tuple, list[tuple]] = {}
+        self._lock = Lock()
+
+    def enqueue(self, bot: Bot, key: tuple, args: tuple) -> None:
+        """Queue a call, func is called with the items of key followed by args."""
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append(args)
+                return
+            self._pending[key] = [args]
+        timer = Timer(self.delay, self._flush, args=(bot, key))
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self, bot: Bot, key: tuple) -> None:
+        while True:
+            with self._lock:
+                calls = self._pending[key]
+                if not calls:
+                    del self._pending[key]
+                    return
+                self._pending[key] = []
+            for args in calls:
+                try:
+                    self.func(*key, *args)
+                except Exception as ex:  # noqa
+                    bot.logger.exception(ex)